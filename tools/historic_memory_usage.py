@@ -54,7 +54,8 @@ def run_on_app(options, commit):
          '--app', app,
          '--compiler', compiler,
          '--timeout', str(options.timeout),
-         '--no-build', '--find-min-xmx']
+         '--no-build', '--find-min-xmx',
+         '--find-min-xmx-seed-hash=HEAD^']
   stdout = subprocess.check_output(cmd)
   output_path = options.output or 'build'
   time_commit = '%s_%s' % (commit.timestamp, commit.git_hash)
@@ -32,6 +32,7 @@
 import gradle
 import optparse
 import os
+import shutil
 import subprocess
 import sys
 import time
@@ -108,6 +109,7 @@ def find_min_xmx_command(record):
       '--find-min-xmx-min-memory=%s' % record['find-xmx-min'],
       '--find-min-xmx-max-memory=%s' % record['find-xmx-max'],
       '--find-min-xmx-range-size=%s' % record['find-xmx-range'],
+      '--find-min-xmx-seed-hash=HEAD^',
       '--find-min-xmx-archive']
 
 def compile_with_memory_max_command(record):
@@ -229,10 +231,17 @@ def archive_log(stdout, stderr, exitcode, timed_out, cmd):
   gs_destination = 'gs://%s' % destination
   url = 'https://storage.cloud.google.com/%s' % destination
   log('Archiving logs to: %s' % gs_destination)
-  utils.archive_value(EXITCODE, gs_destination, exitcode)
-  utils.archive_value(TIMED_OUT, gs_destination, timed_out)
-  utils.archive_file(STDOUT, gs_destination, stdout)
-  utils.archive_file(STDERR, gs_destination, stderr)
+  with utils.TempDir() as temp:
+    for name, value in [(EXITCODE, exitcode), (TIMED_OUT, timed_out)]:
+      with open(os.path.join(temp, name), 'w') as f:
+        f.write(str(value))
+    shutil.copyfile(stdout, os.path.join(temp, STDOUT))
+    shutil.copyfile(stderr, os.path.join(temp, STDERR))
+    utils.upload_files_to_cloud_storage(
+        [os.path.join(temp, name)
+            for name in [EXITCODE, TIMED_OUT, STDOUT, STDERR]],
+        gs_destination,
+        public_read=False)
   log('Logs available at: %s' % url)
 
 def get_magic_file_base_path():
@@ -242,7 +251,8 @@ def get_magic_file_gs_path(name):
   return '%s/%s' % (get_magic_file_base_path(), name)
 
 def get_magic_file_exists(name):
-  return utils.file_exists_on_cloud_storage(get_magic_file_gs_path(name))
+  return utils.file_exists_on_cloud_storage(
+      get_magic_file_gs_path(name), quiet=True)
 
 def delete_magic_file(name):
   utils.delete_file_from_cloud_storage(get_magic_file_gs_path(name))
@@ -252,7 +262,8 @@ def put_magic_file(name, sha):
 
 def get_magic_file_content(name, ignore_errors=False):
   return utils.cat_file_on_cloud_storage(get_magic_file_gs_path(name),
-                                         ignore_errors=ignore_errors)
+                                         ignore_errors=ignore_errors,
+                                         quiet=True)
 
 def print_magic_file_state():
   log('Magic file status:')
@@ -3,29 +3,31 @@
 # for details. All rights reserved. Use of this source code is governed by a
 # BSD-style license that can be found in the LICENSE file.
 
-from __future__ import print_function
-from glob import glob
-import copy
-import optparse
+import argparse
+import collections
+import hashlib
+import importlib
 import os
+import re
+import subprocess
 import sys
 import time
+import types
+try:
+  import fcntl
+except ImportError:
+  # Not a Unix system, creating sanitized libraries is not locked.
+  fcntl = None
 
 import archive
 import as_utils
-import gmail_data
-import gmscore_data
 import golem
-import nest_data
+import gradle
+import jdk
 from sanitize_libraries import SanitizeLibraries, SanitizeLibrariesInPgconf
 import toolhelper
 import update_prebuilds_in_android
 import utils
-import youtube_data
-import chrome_data
-import r8_data
-import iosched_data
-import tachiyomi_data
 
 TYPES = ['dex', 'deploy', 'proguarded']
 APPS = [
@@ -39,163 +41,212 @@ OOM_EXIT_CODE = 42
 # A negative value -N indicates that the child was terminated by signal N.
 TIMEOUT_KILL_CODE = -9
 
+# Cache of libraries sanitized for the app inputs, see SanitizeLibraries.
+SANITIZED_LIBRARIES_DIR = os.path.join(utils.BUILD, 'sanitized_libraries')
+SANITIZE_LIBRARIES_SCRIPT = os.path.join(
+    utils.TOOLS_DIR, 'sanitize_libraries.py')
+
 # Log file names
 FIND_MIN_XMX_FILE = 'find_min_xmx_results'
 FIND_MIN_XMX_DIR = 'find_min_xmx'
 
+# Options whose values are passed on to the compiler.
+FLAG_OPTIONS = ['--compiler-flags', '--r8-flags']
+
 def ParseOptions(argv):
-  result = optparse.OptionParser()
-  result.add_option('--compiler',
+  result = argparse.ArgumentParser()
+  result.add_argument('--compiler',
                     help='The compiler to use',
                     choices=COMPILERS)
-  result.add_option('--compiler-build',
+  result.add_argument('--compiler-build',
                     help='Compiler build to use',
                     choices=COMPILER_BUILDS,
                     default='lib')
-  result.add_option('--hash',
+  result.add_argument('--hash',
                     help='The version of D8/R8 to use')
-  result.add_option('--app',
+  result.add_argument('--app',
                     help='What app to run on',
                     choices=APPS)
-  result.add_option('--run-all',
+  result.add_argument('--run-all',
                     help='Compile all possible combinations',
                     default=False,
                     action='store_true')
-  result.add_option('--expect-oom',
+  result.add_argument('--run-all-workers',
+                    help='Number of combinations to compile in parallel with '
+                         '--run-all, default is based on cores and free memory',
+                    type=int)
+  result.add_argument('--expect-oom',
                     help='Expect that compilation will fail with an OOM',
                     default=False,
                     action='store_true')
-  result.add_option('--type',
+  result.add_argument('--type',
                     help='Default for R8: deploy, for D8: proguarded',
                     choices=TYPES)
-  result.add_option('--out',
+  result.add_argument('--out',
                     help='Where to place the output',
                     default=utils.BUILD)
-  result.add_option('--no-build',
+  result.add_argument('--no-build',
                     help='Run without building first',
                     default=False,
                     action='store_true')
-  result.add_option('--max-memory',
+  result.add_argument('--max-memory',
                     help='The maximum memory in MB to run with',
-                    type='int')
-  result.add_option('--find-min-xmx',
+                    type=int)
+  result.add_argument('--find-min-xmx',
                     help='Find the minimum amount of memory we can run in',
                     default=False,
                     action='store_true')
-  result.add_option('--find-min-xmx-min-memory',
+  result.add_argument('--find-min-xmx-min-memory',
                     help='Setting the minimum memory baseline to run in',
-                    type='int')
-  result.add_option('--find-min-xmx-max-memory',
+                    type=int)
+  result.add_argument('--find-min-xmx-max-memory',
                     help='Setting the maximum memory baseline to run in',
-                    type='int')
-  result.add_option('--find-min-xmx-range-size',
+                    type=int)
+  result.add_argument('--find-min-xmx-range-size',
                     help='Setting the size of the acceptable memory range',
-                    type='int',
+                    type=int,
                     default=32)
-  result.add_option('--find-min-xmx-archive',
+  result.add_argument('--find-min-xmx-archive',
                     help='Archive find-min-xmx results on GCS',
                     default=False,
                     action='store_true')
-  result.add_option('--no-extra-pgconf', '--no_extra_pgconf',
+  result.add_argument('--find-min-xmx-seed-hash',
+                    help='Seed the find-min-xmx search with the range archived '
+                         'on GCS for the given git revision, such as HEAD^')
+  result.add_argument('--no-extra-pgconf', '--no_extra_pgconf',
                     help='Build without the following extra rules: ' +
                          '-printconfiguration, -printmapping, -printseeds, ' +
                          '-printusage',
                     default=False,
                     action='store_true')
-  result.add_option('--timeout',
-                    type='int',
+  result.add_argument('--timeout',
+                    type=int,
                     default=0,
                     help='Set timeout instead of waiting for OOM.')
-  result.add_option('--golem',
+  result.add_argument('--golem',
                     help='Running on golem, do not build or download',
                     default=False,
                     action='store_true')
-  result.add_option('--ignore-java-version',
+  result.add_argument('--ignore-java-version',
                     help='Do not check java version',
                     default=False,
                     action='store_true')
-  result.add_option('--no-libraries',
+  result.add_argument('--no-libraries',
                     help='Do not pass in libraries, even if they exist in conf',
                     default=False,
                     action='store_true')
-  result.add_option('--no-debug',
+  result.add_argument('--no-debug',
                     help='Run without debug asserts.',
                     default=False,
                     action='store_true')
-  result.add_option('--debug-agent',
+  result.add_argument('--debug-agent',
                     help='Run with debug agent.',
                     default=False,
                     action='store_true')
-  result.add_option('--version',
+  result.add_argument('--version',
                     help='The version of the app to run')
-  result.add_option('-k',
+  result.add_argument('-k',
                     help='Override the default ProGuard keep rules')
-  result.add_option('--compiler-flags',
+  result.add_argument('--compiler-flags',
                     help='Additional option(s) for the compiler. ' +
                          'If passing several options use a quoted string.')
-  result.add_option('--r8-flags',
+  result.add_argument('--r8-flags',
                     help='Additional option(s) for the compiler. ' +
                          'Same as --compiler-flags, keeping it for backward'
                          ' compatibility. ' +
                          'If passing several options use a quoted string.')
   # TODO(tamaskenez) remove track-memory-to-file as soon as we updated golem
   # to use --print-memoryuse instead
-  result.add_option('--track-memory-to-file',
+  result.add_argument('--track-memory-to-file',
                     help='Track how much memory the jvm is using while ' +
                     ' compiling. Output to the specified file.')
-  result.add_option('--profile',
+  result.add_argument('--profile',
                     help='Profile R8 run.',
                     default=False,
                     action='store_true')
-  result.add_option('--dump-args-file',
+  result.add_argument('--dump-args-file',
                     help='Dump a file with the arguments for the specified ' +
                     'configuration. For use as a @<file> argument to perform ' +
                     'the run.')
-  result.add_option('--print-runtimeraw',
+  result.add_argument('--print-runtimeraw',
                     metavar='BENCHMARKNAME',
                     help='Print the line \'<BENCHMARKNAME>(RunTimeRaw):' +
                         ' <elapsed> ms\' at the end where <elapsed> is' +
                         ' the elapsed time in milliseconds.')
-  result.add_option('--print-memoryuse',
+  result.add_argument('--print-memoryuse',
                     metavar='BENCHMARKNAME',
                     help='Print the line \'<BENCHMARKNAME>(MemoryUse):' +
                         ' <mem>\' at the end where <mem> is the peak' +
                         ' peak resident set size (VmHWM) in bytes.')
-  result.add_option('--print-dexsegments',
+  result.add_argument('--print-dexsegments',
                     metavar='BENCHMARKNAME',
                     help='Print the sizes of individual dex segments as ' +
                         '\'<BENCHMARKNAME>-<segment>(CodeSize): <bytes>\'')
-  result.add_option('--track-time-in-memory',
+  result.add_argument('--track-time-in-memory',
                     help='Plot the times taken from memory starting point to '
                          'end-point with defined memory increment',
                     default=False,
                     action='store_true')
-  result.add_option('--track-time-in-memory-max',
+  result.add_argument('--track-time-in-memory-max',
                     help='Setting the maximum memory baseline to run in',
-                    type='int')
-  result.add_option('--track-time-in-memory-min',
+                    type=int)
+  result.add_argument('--track-time-in-memory-min',
                     help='Setting the minimum memory baseline to run in',
-                    type='int')
-  result.add_option('--track-time-in-memory-increment',
+                    type=int)
+  result.add_argument('--track-time-in-memory-increment',
                     help='Setting the increment',
-                    type='int',
+                    type=int,
                     default=32)
-  result.add_option('--print-times',
+  result.add_argument('--print-times',
                     help='Include timing',
                     default=False,
                     action='store_true')
-  result.add_option('--cpu-list',
+  result.add_argument('--cpu-list',
                     help='Run under \'taskset\' with these CPUs. See '
                          'the \'taskset\' -c option for the format')
-  result.add_option('--quiet',
+  result.add_argument('--class-data-archive',
+                    help='Share the class data of the JDK between runs '
+                         'through this archive, it is created by the first '
+                         'run. Runs without sharing if the archive cannot '
+                         'be created')
+  result.add_argument('--early-oom-abort',
+                      help='Kill the compiler and report an OOM when its '
+                           'resident memory stays above 95%% of -Xmx '
+                           'while it spends nearly all of its time in '
+                           'garbage collection pauses, instead of waiting '
+                           'for the JVM to run out of memory',
+                      default=False,
+                      action='store_true')
+  result.add_argument('--quiet',
                     help='Disable compiler logging',
                     default=False,
                     action='store_true')
-  (options, args) = result.parse_args(argv)
+  result.add_argument('args',
+                      help='Additional arguments for the compiler',
+                      nargs='*')
+  # Everything after -- is passed on to the compiler as is.
+  argv = list(argv)
+  passthrough = []
+  if '--' in argv:
+    index = argv.index('--')
+    (argv, passthrough) = (argv[:index], argv[index + 1:])
+  # The flag options take values that start with '-', which argparse would
+  # read as an option, so attach the value like optparse did.
+  index = 0
+  while index < len(argv) - 1:
+    if argv[index] in FLAG_OPTIONS:
+      argv[index:index + 2] = ['%s=%s' % (argv[index], argv[index + 1])]
+    index += 1
+  options = result.parse_intermixed_args(argv)
+  args = options.args + passthrough
   assert not options.hash or options.no_build, (
       'Argument --no-build is required when using --hash')
   assert not options.hash or options.compiler_build == 'full', (
       'Compiler build lib not yet supported with --hash')
+  # The memory of the compiler is watched through the pid of the process we
+  # start, with --track-memory-to-file that is the tracking script.
+  assert not options.early_oom_abort or not options.track_memory_to_file, (
+      'Argument --early-oom-abort is not supported with --track-memory-to-file')
   return (options, args)
 
 # Most apps have -printmapping, -printseeds, -printusage and
@@ -218,50 +269,203 @@ DISABLED_PERMUTATIONS = [
   # (app, version, type), e.g., ('gmail', '180826.15', 'deploy')
 ]
 
+# The data module and default version for each app. The data modules are only
+# imported when needed.
+APP_DATA = {
+    'gmscore': ('gmscore_data', 'v9'),
+    'nest': ('nest_data', '20180926'),
+    'youtube': ('youtube_data', '12.22'),
+    'chrome': ('chrome_data', '180917'),
+    'gmail': ('gmail_data', '170604.16'),
+    'r8': ('r8_data', 'cf'),
+    'iosched': ('iosched_data', '2019'),
+    'tachiyomi': ('tachiyomi_data', 'b15d2fe16864645055af6a745a62cc5566629798'),
+}
+# Check to ensure that we add all variants here.
+assert len(APPS) == len(APP_DATA)
+
+def get_app_data(app):
+  return importlib.import_module(APP_DATA[app][0])
+
+# Computed on first use since it imports all the app data modules.
+app_permutations = None
+
 def get_permutations():
-  data_providers = {
-      'gmscore': gmscore_data,
-      'nest': nest_data,
-      'youtube': youtube_data,
-      'chrome': chrome_data,
-      'gmail': gmail_data,
-      'r8': r8_data,
-      'iosched': iosched_data,
-      'tachiyomi': tachiyomi_data
-  }
-  # Check to ensure that we add all variants here.
-  assert len(APPS) == len(data_providers)
-  for app, data in data_providers.items():
-    for version in data.VERSIONS:
-      for type in data.VERSIONS[version]:
-        if (app, version, type) not in DISABLED_PERMUTATIONS:
-          for use_r8lib in [False, True]:
-            yield app, version, type, use_r8lib
+  global app_permutations
+  if app_permutations is None:
+    app_permutations = tuple(
+        (app, version, type, use_r8lib)
+        for app in APP_DATA
+        for version, types in get_app_data(app).VERSIONS.items()
+        for type in types
+        if (app, version, type) not in DISABLED_PERMUTATIONS
+        for use_r8lib in [False, True])
+  return app_permutations
+
+def get_run_all_workers(options):
+  if options.run_all_workers:
+    return options.run_all_workers
+  # Each compilation can use up to its -Xmx, so do not start more of them than
+  # fit in the available memory.
+  available_mb = get_available_memory_mb()
+  if available_mb is None:
+    return 1
+  if options.find_min_xmx:
+    per_run_mb = options.find_min_xmx_max_memory or 8192
+  else:
+    per_run_mb = options.max_memory or 8192
+  per_run_mb = max(per_run_mb, 1024)
+  return max(1, min((os.cpu_count() or 2) // 2, available_mb // per_run_mb))
+
+# The kernel's estimate of the memory that can be used without swapping, which
+# unlike the free memory includes the reclaimable page cache.
+def get_available_memory_mb():
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) // 1024
+  except (IOError, OSError):
+    pass
+  return None
+
+# Returns a copy of the options with the given values replaced.
+def override_options(options, **overrides):
+  values = vars(options).copy()
+  values.update(overrides)
+  return types.SimpleNamespace(**values)
 
 def run_all(options, args):
   # Args will be destroyed
   assert len(args) == 0
+  permutations = []
   for name, version, type, use_r8lib in get_permutations():
     compiler = 'r8' if type == 'deploy' else 'd8'
     compiler_build = 'lib' if use_r8lib else 'full'
-    print('Executing %s/%s with %s %s %s' % (compiler, compiler_build, name,
-      version, type))
-
-    fixed_options = copy.copy(options)
-    fixed_options.app = name
-    fixed_options.version = version
-    fixed_options.compiler = compiler
-    fixed_options.compiler_build = compiler_build
-    fixed_options.type = type
-    exit_code = run_with_options(fixed_options, [])
-    if exit_code != 0:
-      print('Failed %s %s %s with %s/%s' % (name, version, type, compiler,
-        compiler_build))
-      exit(exit_code)
+    # Separate output directories so parallel runs do not clobber each other.
+    out = os.path.join(options.out, '%s-%s-%s-%s' % (
+        name, version, type, compiler_build))
+    permutations.append(override_options(options,
+        app=name,
+        version=version,
+        compiler=compiler,
+        compiler_build=compiler_build,
+        type=type,
+        out=out,
+        no_build=True))
+
+  # Build the compilers once up front, the parallel runs must not build and
+  # update dependencies that the other runs are using.
+  if not options.no_build and not options.golem:
+    gradle.RunGradle(['r8', 'r8lib'])
+
+  # Imported here as this module is also imported from Python 2 scripts.
+  import concurrent.futures
+  workers = get_run_all_workers(options)
+  print('Running %s combinations with %s workers' % (len(permutations), workers))
+  # With --find-min-xmx-archive the results are staged locally and uploaded
+  # with a single gsutil invocation when all the runs are done.
+  with utils.TempDir() as stage, concurrent.futures.ProcessPoolExecutor(
+      max_workers=workers) as executor:
+    futures = {}
+    try:
+      for fixed_options in permutations:
+        futures[executor.submit(run_permutation, fixed_options, stage)] = (
+            fixed_options)
+      for future in concurrent.futures.as_completed(futures):
+        exit_code = future.result()
+        if exit_code != 0:
+          fixed_options = futures[future]
+          print('Failed %s %s %s with %s/%s' % (fixed_options.app,
+            fixed_options.version, fixed_options.type, fixed_options.compiler,
+            fixed_options.compiler_build))
+          exit(exit_code)
+    except BaseException:
+      # Whether a combination failed or raised, do not wait for the ones that
+      # have not started yet.
+      for pending in futures:
+        pending.cancel()
+      raise
+    finally:
+      # Also upload the results of the runs that completed before a failure.
+      staged = os.path.join(stage, utils.R8_TEST_RESULTS_BUCKET)
+      if os.path.isdir(staged):
+        executor.shutdown(wait=True)
+        utils.upload_dir_to_cloud_storage(
+            os.path.join(staged, FIND_MIN_XMX_DIR),
+            'gs://%s' % utils.R8_TEST_RESULTS_BUCKET,
+            public_read=False)
+
+def run_permutation(options, stage_dir):
+  print('Executing %s/%s with %s %s %s' % (options.compiler,
+    options.compiler_build, options.app, options.version, options.type))
+  sys.stdout.flush()
+  if options.find_min_xmx:
+    return find_min_xmx(options, [], stage_dir=stage_dir)
+  return run_with_options(options, [])
+
+def find_min_xmx_probe(prepared, candidate):
+  # Returns True if we can run in candidate MB, False if we OOM or time out and
+  # None on any other failure.
+  t0 = time.time()
+  exit_code = execute_prepared_run(prepared, xmx=candidate)
+  t1 = time.time()
+  print('Running took: %s ms' % (1000.0 * (t1 - t0)))
+  if exit_code == 0:
+    return True
+  if exit_code not in [OOM_EXIT_CODE, TIMEOUT_KILL_CODE]:
+    print('Non OOM/Timeout error executing, exiting')
+    return None
+  if exit_code == TIMEOUT_KILL_CODE:
+    print('Timeout. Continue to the next candidate.')
+  return False
+
+def get_min_xmx_destination(options, sha):
+  (version, _) = get_version_and_data(options)
+  return os.path.join(
+      utils.R8_TEST_RESULTS_BUCKET,
+      FIND_MIN_XMX_DIR,
+      sha,
+      options.compiler,
+      options.compiler_build,
+      options.app,
+      version,
+      get_type(options))
 
-def find_min_xmx(options, args):
+# Returns the hash of a git revision, or None if it is not in the checkout.
+def get_seed_sha1(revision):
+  cmd = ['git', 'rev-parse', '--verify', '--quiet', revision]
+  utils.PrintCmd(cmd)
+  with utils.ChangedWorkingDirectory(utils.REPO_ROOT):
+    try:
+      return subprocess.check_output(cmd).decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+      print('No seed for find-min-xmx, %s not found' % revision)
+      return None
+
+def get_archived_min_xmx_range(options, sha):
+  gs_location = 'gs://%s/%s' % (
+      get_min_xmx_destination(options, sha), FIND_MIN_XMX_FILE)
+  value = utils.cat_file_on_cloud_storage(gs_location, ignore_errors=True)
+  if isinstance(value, bytes):
+    value = value.decode('utf-8')
+  m = re.search('Found range: ([0-9]+) - ([0-9]+)', value)
+  if m is None:
+    return None
+  return (int(m.group(1)), int(m.group(2)))
+
+def find_min_xmx(options, args, stage_dir=None):
   # Args will be destroyed
   assert len(args) == 0
+  # Everything but the -Xmx is the same for all the runs, so only prepare once.
+  with utils.TempDir() as temp:
+    prepared = prepare_run(options, [], temp)
+    if prepared is None:
+      return 2
+    return search_min_xmx(prepared, stage_dir)
+
+def search_min_xmx(prepared, stage_dir=None):
+  options = prepared.options
   # If we can run in 128 MB then we are good (which we can for small examples
   # or D8 on medium sized examples)
   if options.find_min_xmx_min_memory:
@@ -274,29 +478,75 @@ def find_min_xmx(options, args):
     working = options.find_min_xmx_max_memory
   else:
     working = 1024 * 8
-  exit_code = 0
+  min_memory = not_working
+  max_memory = working
   range = int(options.find_min_xmx_range_size)
-  while working - not_working > range:
-    next_candidate = int(working - ((working - not_working)/2))
-    print('working: %s, non_working: %s, next_candidate: %s' %
-          (working, not_working, next_candidate))
-    extra_args = ['-Xmx%sM' % next_candidate]
-    t0 = time.time()
-    exit_code = run_with_options(options, [], extra_args)
-    t1 = time.time()
-    print('Running took: %s ms' % (1000.0 * (t1 - t0)))
-    if exit_code != 0:
-      if exit_code not in [OOM_EXIT_CODE, TIMEOUT_KILL_CODE]:
-        print('Non OOM/Timeout error executing, exiting')
+  # The upper bound is only assumed to work until a probe has confirmed it.
+  working_confirmed = True
+  prior_range = None
+  if options.find_min_xmx_seed_hash:
+    seed_sha = get_seed_sha1(options.find_min_xmx_seed_hash)
+    if seed_sha:
+      prior_range = get_archived_min_xmx_range(options, seed_sha)
+  if prior_range:
+    # Start the search just around the previously found range.
+    (prior_not_working, prior_working) = prior_range
+    print('Seeding with prior range: %s - %s' % prior_range)
+    not_working = min(max(min_memory, prior_not_working - range), max_memory)
+    working = max(min(max_memory, prior_working + range), not_working)
+    working_confirmed = working == max_memory
+    if not_working > min_memory:
+      # Check that the seeded lower bound still fails, otherwise search below.
+      print('Checking seeded lower bound: %s' % not_working)
+      result = find_min_xmx_probe(prepared, not_working)
+      if result is None:
         return 2
-    if exit_code == 0:
-      working = next_candidate
-    elif exit_code == TIMEOUT_KILL_CODE:
-      print('Timeout. Continue to the next candidate.')
-      not_working = next_candidate
-    else:
-      assert exit_code == OOM_EXIT_CODE
+      if result:
+        working = not_working
+        working_confirmed = True
+        not_working = min_memory
+  else:
+    # Double the lower bound until we find a working candidate. This takes
+    # fewer runs than bisecting the full interval when the answer is close to
+    # the lower bound, and about one more when it is close to the upper bound.
+    next_candidate = not_working * 2
+    while next_candidate < working:
+      print('working: %s, non_working: %s, next_candidate: %s' %
+            (working, not_working, next_candidate))
+      result = find_min_xmx_probe(prepared, next_candidate)
+      if result is None:
+        return 2
+      if result:
+        working = next_candidate
+        break
       not_working = next_candidate
+      next_candidate *= 2
+
+  while True:
+    while working - not_working > range:
+      next_candidate = working - ((working - not_working) // 2)
+      print('working: %s, non_working: %s, next_candidate: %s' %
+            (working, not_working, next_candidate))
+      result = find_min_xmx_probe(prepared, next_candidate)
+      if result is None:
+        return 2
+      if result:
+        working = next_candidate
+        working_confirmed = True
+      else:
+        not_working = next_candidate
+    if working_confirmed:
+      break
+    # The seeded upper bound was never run, check that it actually works and
+    # otherwise continue the search above it.
+    print('Checking seeded upper bound: %s' % working)
+    result = find_min_xmx_probe(prepared, working)
+    if result is None:
+      return 2
+    working_confirmed = True
+    if not result:
+      not_working = working
+      working = max_memory
 
   assert working - not_working <= range
   found_range = 'Found range: %s - %s' % (not_working, working)
@@ -304,18 +554,16 @@ def find_min_xmx(options, args):
 
   if options.find_min_xmx_archive:
     sha = utils.get_HEAD_sha1()
-    (version, _) = get_version_and_data(options)
-    destination = os.path.join(
-        utils.R8_TEST_RESULTS_BUCKET,
-        FIND_MIN_XMX_DIR,
-        sha,
-        options.compiler,
-        options.compiler_build,
-        options.app,
-        version,
-        get_type(options))
-    gs_destination = 'gs://%s' % destination
-    utils.archive_value(FIND_MIN_XMX_FILE, gs_destination, found_range + '\n')
+    destination = get_min_xmx_destination(options, sha)
+    if stage_dir:
+      # Uploaded by run_all together with the results of the other runs.
+      staged_dir = os.path.join(stage_dir, destination)
+      utils.makedirs_if_needed(staged_dir)
+      with open(os.path.join(staged_dir, FIND_MIN_XMX_FILE), 'w') as f:
+        f.write(found_range + '\n')
+    else:
+      utils.archive_value(
+          FIND_MIN_XMX_FILE, 'gs://%s' % destination, found_range + '\n')
 
   return 0
 
@@ -327,12 +575,8 @@ def print_min_xmx_ranges_for_hash(hash, compiler, compiler_build):
       compiler,
       compiler_build)
   gs_base = 'gs://%s' % app_directory
-  for app in utils.ls_files_on_cloud_storage(gs_base).strip().split('\n'):
-    for version in utils.ls_files_on_cloud_storage(app).strip().split('\n'):
-      for type in utils.ls_files_on_cloud_storage(version).strip().split('\n'):
-        gs_location = '%s%s' % (type, FIND_MIN_XMX_FILE)
-        value = utils.cat_file_on_cloud_storage(gs_location, ignore_errors=True)
-        print('%s\n' % value)
+  for _, value in utils.cat_files_on_cloud_storage(gs_base, FIND_MIN_XMX_FILE):
+    print('%s\n' % value)
 
 def track_time_in_memory(options, args):
   # Args will be destroyed
@@ -352,12 +596,15 @@ def track_time_in_memory(options, args):
   current = options.track_time_in_memory_min
   print('Memory (KB)\tTime (ms)')
   with utils.TempDir() as temp:
+    prepared = prepare_run(options, [], temp, quiet=True)
+    if prepared is None:
+      return 1
     stdout = os.path.join(temp, 'stdout')
     stdout_fd = open(stdout, 'w')
     while current <= options.track_time_in_memory_max:
-      extra_args = ['-Xmx%sM' % current]
       t0 = time.time()
-      exit_code = run_with_options(options, [], extra_args, stdout_fd, quiet=True)
+      exit_code = execute_prepared_run(
+          prepared, xmx=current, stdout=stdout_fd, quiet=True)
       t1 = time.time()
       total = (1000.0 * (t1 - t0)) if exit_code == 0 else -1
       print('%s\t%s' % (current, total))
@@ -388,33 +635,10 @@ def main(argv):
   return exit_code
 
 def get_version_and_data(options):
-  if options.app == 'gmscore':
-    version = options.version or 'v9'
-    data = gmscore_data
-  elif options.app == 'nest':
-    version = options.version or '20180926'
-    data = nest_data
-  elif options.app == 'youtube':
-    version = options.version or '12.22'
-    data = youtube_data
-  elif options.app == 'chrome':
-    version = options.version or '180917'
-    data = chrome_data
-  elif options.app == 'gmail':
-    version = options.version or '170604.16'
-    data = gmail_data
-  elif options.app == 'r8':
-    version = options.version or 'cf'
-    data = r8_data
-  elif options.app == 'iosched':
-    version = options.version or '2019'
-    data = iosched_data
-  elif options.app == 'tachiyomi':
-    version = options.version or 'b15d2fe16864645055af6a745a62cc5566629798'
-    data = tachiyomi_data
-  else:
+  if options.app not in APP_DATA:
     raise Exception("You need to specify '--app={}'".format('|'.join(APPS)))
-  return version, data
+  (_, default_version) = APP_DATA[options.app]
+  return options.version or default_version, get_app_data(options.app)
 
 def get_type(options):
   if not options.type:
@@ -450,16 +674,121 @@ def check_no_injars_and_no_libraryjars(pgconfs):
         elif trimmed.startswith('-libraryjars'):
           raise Exception("Unexpected -libraryjars found in " + pgconf)
 
-def run_with_options(options, args, extra_args=None, stdout=None, quiet=False):
-  if extra_args is None:
-    extra_args = []
+def get_injars_and_libraryjars(pgconfs):
+  injars = []
+  libraryjars = []
+  for pgconf in pgconfs:
+    pgconf_dirname = os.path.abspath(os.path.dirname(pgconf))
+    with open(pgconf) as pgconf_file:
+      for line in pgconf_file:
+        trimmed = line.strip()
+        if trimmed.startswith('-injars'):
+          injars.append(os.path.join(
+              pgconf_dirname, trimmed[len('-injars'):].strip()))
+        elif trimmed.startswith('-libraryjars'):
+          libraryjars.append(os.path.join(
+              pgconf_dirname, trimmed[len('-libraryjars'):].strip()))
+  return (injars, libraryjars)
+
+# Sanitized libraries are stored in a directory named by a hash of the
+# sanitizer, the Proguard configurations and the size and modification time of
+# the jars, such that they are only created again when one of these changes.
+def get_sanitized_libraries_dir(pgconfs, injars, libraryjars):
+  key = hashlib.sha256()
+  with open(SANITIZE_LIBRARIES_SCRIPT, 'rb') as script:
+    key.update(script.read())
+  for pgconf in pgconfs:
+    key.update(('pgconf %s\n' % os.path.abspath(pgconf)).encode('utf-8'))
+    with open(pgconf, 'rb') as pgconf_file:
+      key.update(pgconf_file.read())
+  for kind, jars in [('injar', injars), ('libraryjar', libraryjars)]:
+    for jar in jars:
+      stat = os.stat(jar)
+      key.update(('%s %s %s %s\n' % (kind, os.path.abspath(jar),
+          stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+  return os.path.join(SANITIZED_LIBRARIES_DIR, key.hexdigest()[:16])
+
+# Runs create unless the sanitized libraries in cache_dir already exist. The
+# directory is locked while creating, as parallel runs can share it.
+def ensure_sanitized_libraries(cache_dir, create):
+  done_marker = os.path.join(cache_dir, 'done')
+  if os.path.exists(done_marker):
+    return
+  utils.makedirs_if_needed(cache_dir)
+  with open(os.path.join(cache_dir, 'lock'), 'w') as lock:
+    if fcntl:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+    if not os.path.exists(done_marker):
+      create()
+      open(done_marker, 'w').close()
+
+# A JVM started with the same class data archive maps the archived classes
+# instead of loading and verifying them again.
+def get_class_data_sharing_args(class_data_archive, quiet=False):
+  if not os.path.exists(class_data_archive):
+    # Dump to a private file first such that parallel runs never map a
+    # partially written archive.
+    dump_file = '%s.%s' % (class_data_archive, os.getpid())
+    cmd = [jdk.GetJavaExecutable(),
+        '-XX:+UnlockDiagnosticVMOptions',
+        '-XX:SharedArchiveFile=%s' % dump_file,
+        '-Xshare:dump']
+    utils.PrintCmd(cmd, quiet=quiet)
+    try:
+      subprocess.check_call(cmd, stdout=subprocess.DEVNULL if quiet else None)
+      os.replace(dump_file, class_data_archive)
+    except (subprocess.CalledProcessError, OSError) as e:
+      # Sharing is only an optimization, run without it.
+      print('Not sharing class data, failed to create %s: %s' % (
+          class_data_archive, e))
+      if os.path.exists(dump_file):
+        os.remove(dump_file)
+      return []
+  # Fall back to not sharing if the archive cannot be mapped.
+  return [
+      '-XX:+UnlockDiagnosticVMOptions',
+      '-XX:SharedArchiveFile=%s' % class_data_archive,
+      '-Xshare:auto']
+
+# Keeps the last lines that the compiler writes to stderr and records if it
+# ran out of memory, without keeping all of the output.
+class StderrTail(object):
+  def __init__(self, max_lines=4096):
+    self.lines = collections.deque(maxlen=max_lines)
+    self.oom = False
+
+  def __call__(self, line):
+    self.lines.append(line)
+    if 'java.lang.OutOfMemoryError' in line:
+      self.oom = True
+
+# The part of a run that is the same for repeated runs with different -Xmx.
+# The JVM arguments are all but the -Xmx, which is given when executing.
+class PreparedRun(object):
+  def __init__(self, options, tool, args, jvm_args, temp, build, jar, main):
+    self.options = options
+    self.tool = tool
+    self.args = args
+    self.jvm_args = jvm_args
+    self.temp = temp
+    self.build = build
+    self.jar = jar
+    self.main = main
+
+def run_with_options(options, args, xmx=None, stdout=None, quiet=False):
+  with utils.TempDir() as temp:
+    prepared = prepare_run(options, args, temp, quiet=quiet)
+    if prepared is None:
+      return 1
+    return execute_prepared_run(prepared, xmx, stdout, quiet)
+
+# Validates the options, sanitizes libraries and builds the compiler arguments.
+# Files needed by the run are placed in temp, which must outlive all
+# executions of the returned PreparedRun. Returns None for an unknown version
+# or type.
+def prepare_run(options, args, temp, quiet=False):
+  jvm_args = []
   app_provided_pg_conf = False;
-  # todo(121018500): remove when memory is under control
-  if not any('-Xmx' in arg for arg in extra_args):
-    if options.max_memory:
-      extra_args.append('-Xmx%sM' % options.max_memory)
-    else:
-      extra_args.append('-Xmx8G')
   if options.golem:
     golem.link_third_party()
     options.out = os.getcwd()
@@ -467,7 +796,11 @@ def run_with_options(options, args, extra_args=None, stdout=None, quiet=False):
     utils.check_java_version()
 
   if options.print_times:
-    extra_args.append('-Dcom.android.tools.r8.printtimes=1')
+    jvm_args.append('-Dcom.android.tools.r8.printtimes=1')
+
+  if options.class_data_archive:
+    jvm_args.extend(
+        get_class_data_sharing_args(options.class_data_archive, quiet))
 
   outdir = options.out
   (version_id, data) = get_version_and_data(options)
@@ -484,7 +817,7 @@ def run_with_options(options, args, extra_args=None, stdout=None, quiet=False):
     print('No version {} for application {}'
         .format(version_id, options.app))
     print('Valid versions are {}'.format(data.VERSIONS.keys()))
-    return 1
+    return None
 
   version = data.VERSIONS[version_id]
 
@@ -493,7 +826,7 @@ def run_with_options(options, args, extra_args=None, stdout=None, quiet=False):
   if type not in version:
     print('No type {} for version {}'.format(type, version))
     print('Valid types are {}'.format(version.keys()))
-    return 1
+    return None
   values = version[type]
   inputs = []
   # For R8 'deploy' the JAR is located using the Proguard configuration
@@ -519,12 +852,14 @@ def run_with_options(options, args, extra_args=None, stdout=None, quiet=False):
   if options.compiler == 'r8':
     if 'pgconf' in values and not options.k:
       if has_injars_and_libraryjars(values['pgconf']):
-        sanitized_lib_path = os.path.join(
-            os.path.abspath(outdir), 'sanitized_lib.jar')
-        sanitized_pgconf_path = os.path.join(
-            os.path.abspath(outdir), 'sanitized.config')
-        SanitizeLibrariesInPgconf(
-            sanitized_lib_path, sanitized_pgconf_path, values['pgconf'])
+        (injars, libraryjars) = get_injars_and_libraryjars(values['pgconf'])
+        cache_dir = get_sanitized_libraries_dir(
+            values['pgconf'], injars, libraryjars)
+        sanitized_lib_path = os.path.join(cache_dir, 'sanitized_lib.jar')
+        sanitized_pgconf_path = os.path.join(cache_dir, 'sanitized.config')
+        ensure_sanitized_libraries(cache_dir,
+            lambda: SanitizeLibrariesInPgconf(
+                sanitized_lib_path, sanitized_pgconf_path, values['pgconf']))
         libraries = [sanitized_lib_path]
         args.extend(['--pg-conf', sanitized_pgconf_path])
       else:
@@ -533,10 +868,12 @@ def run_with_options(options, args, extra_args=None, stdout=None, quiet=False):
         for pgconf in values['pgconf']:
           args.extend(['--pg-conf', pgconf])
         if 'sanitize_libraries' in values and values['sanitize_libraries']:
-          sanitized_lib_path = os.path.join(
-              os.path.abspath(outdir), 'sanitized_lib.jar')
-          SanitizeLibraries(
-            sanitized_lib_path, values['libraries'], values['inputs'])
+          cache_dir = get_sanitized_libraries_dir(
+              [], values['inputs'], values['libraries'])
+          sanitized_lib_path = os.path.join(cache_dir, 'sanitized_lib.jar')
+          ensure_sanitized_libraries(cache_dir,
+              lambda: SanitizeLibraries(
+                  sanitized_lib_path, values['libraries'], values['inputs']))
           libraries = [sanitized_lib_path]
           inputs = values['inputs']
       app_provided_pg_conf = True
@@ -546,14 +883,14 @@ def run_with_options(options, args, extra_args=None, stdout=None, quiet=False):
       for rules in values['maindexrules']:
         args.extend(['--main-dex-rules', rules])
     if 'allow-type-errors' in values:
-      extra_args.append('-Dcom.android.tools.r8.allowTypeErrors=1')
-    extra_args.append(
+      jvm_args.append('-Dcom.android.tools.r8.allowTypeErrors=1')
+    jvm_args.append(
         '-Dcom.android.tools.r8.disallowClassInlinerGracefulExit=1')
 
   if options.debug_agent:
     if not options.compiler_build == 'full':
       print('WARNING: Running debugging agent on r8lib is questionable...')
-    extra_args.append(
+    jvm_args.append(
       '-agentlib:jdwp=transport=dt_socket,server=y,suspend=y,address=*:5005')
 
   if not options.no_libraries:
@@ -596,77 +933,106 @@ def run_with_options(options, args, extra_args=None, stdout=None, quiet=False):
 
   args.extend(inputs)
 
+  if (options.compiler == 'r8' and app_provided_pg_conf
+      and not options.no_extra_pgconf and not options.dump_args_file):
+    # Ensure that output of -printmapping and -printseeds go to the output
+    # location and not where the app Proguard configuration places them.
+    if outdir.endswith('.zip') or outdir.endswith('.jar'):
+      pg_outdir = os.path.dirname(outdir)
+    else:
+      pg_outdir = outdir
+    additional_pg_conf = GenerateAdditionalProguardConfiguration(
+        temp, os.path.abspath(pg_outdir))
+    args.extend(['--pg-conf', additional_pg_conf])
+
+  build = not options.no_build and not options.golem
+  jar = None
+  main = None
+  if options.compiler_build == 'full':
+    tool = options.compiler
+  else:
+    assert(options.compiler_build == 'lib')
+    tool = 'r8lib-' + options.compiler
+  if options.hash:
+    jar = os.path.join(utils.LIBS, 'r8-' + options.hash + '.jar')
+    main = 'com.android.tools.r8.' + options.compiler.upper()
+  return PreparedRun(options, tool, args, jvm_args, temp, build, jar, main)
+
+# Runs the compiler with a maximum heap of xmx MB, defaulting to --max-memory.
+def execute_prepared_run(prepared, xmx=None, stdout=None, quiet=False):
+  options = prepared.options
+  if xmx is None:
+    # todo(121018500): remove when memory is under control
+    xmx = options.max_memory or 8 * 1024
+  extra_args = ['-Xmx%sM' % xmx] + prepared.jvm_args
+  outdir = options.out
+
   t0 = time.time()
   if options.dump_args_file:
     with open(options.dump_args_file, 'w') as args_file:
-      args_file.writelines([arg + os.linesep for arg in args])
+      args_file.writelines([arg + os.linesep for arg in prepared.args])
   else:
-    with utils.TempDir() as temp:
-      if options.print_memoryuse and not options.track_memory_to_file:
-        options.track_memory_to_file = os.path.join(temp,
-            utils.MEMORY_USE_TMP_FILE)
-      if options.compiler == 'r8' and app_provided_pg_conf:
-        # Ensure that output of -printmapping and -printseeds go to the output
-        # location and not where the app Proguard configuration places them.
-        if outdir.endswith('.zip') or outdir.endswith('.jar'):
-          pg_outdir = os.path.dirname(outdir)
-        else:
-          pg_outdir = outdir
-        if not options.no_extra_pgconf:
-          additional_pg_conf = GenerateAdditionalProguardConfiguration(
-              temp, os.path.abspath(pg_outdir))
-          args.extend(['--pg-conf', additional_pg_conf])
-      build = not options.no_build and not options.golem
-      stderr_path = os.path.join(temp, 'stderr')
-      with open(stderr_path, 'w') as stderr:
-        jar = None
-        main = None
-        if options.compiler_build == 'full':
-          tool = options.compiler
-        else:
-          assert(options.compiler_build == 'lib')
-          tool = 'r8lib-' + options.compiler
-        if options.hash:
-          jar = os.path.join(utils.LIBS, 'r8-' + options.hash + '.jar')
-          main = 'com.android.tools.r8.' + options.compiler.upper()
-        exit_code = toolhelper.run(tool, args,
-            build=build,
-            debug=not options.no_debug,
-            profile=options.profile,
-            track_memory_file=options.track_memory_to_file,
-            extra_args=extra_args,
-            stdout=stdout,
-            stderr=stderr,
-            timeout=options.timeout,
-            quiet=quiet,
-            cmd_prefix=[
-                'taskset', '-c', options.cpu_list] if options.cpu_list else [],
-            jar=jar,
-            main=main)
-      if exit_code != 0:
-        with open(stderr_path) as stderr:
-          stderr_text = stderr.read()
-          if not quiet:
-            print(stderr_text)
-          if 'java.lang.OutOfMemoryError' in stderr_text:
-            if not quiet:
-              print('Failure was OOM')
-            return OOM_EXIT_CODE
-          return exit_code
-
-      if options.print_memoryuse:
-        print('{}(MemoryUse): {}'
-            .format(options.print_memoryuse,
-                utils.grep_memoryuse(options.track_memory_to_file)))
+    peak_memory_file = None
+    if options.print_memoryuse and not options.track_memory_to_file:
+      peak_memory_file = os.path.join(prepared.temp, utils.MEMORY_USE_TMP_FILE)
+    stderr_tail = StderrTail()
+    memory_watcher = None
+    if options.early_oom_abort:
+      gc_log = os.path.join(prepared.temp, 'gc.log')
+      extra_args.append('-Xlog:gc:file=%s' % gc_log)
+      memory_watcher = toolhelper.MemoryWatcher(
+          int(0.95 * xmx * 1024), gc_log)
+    exit_code = toolhelper.run(prepared.tool, prepared.args,
+        build=prepared.build,
+        debug=not options.no_debug,
+        profile=options.profile,
+        track_memory_file=options.track_memory_to_file,
+        extra_args=extra_args,
+        stdout=stdout,
+        timeout=options.timeout,
+        quiet=quiet,
+        cmd_prefix=[
+            'taskset', '-c', options.cpu_list] if options.cpu_list else [],
+        jar=prepared.jar,
+        main=prepared.main,
+        peak_memory_file=peak_memory_file,
+        stderr_handler=stderr_tail,
+        memory_watcher=memory_watcher)
+    if memory_watcher and memory_watcher.killed:
+      if not quiet:
+        print('Failure was OOM, killed when out of memory')
+      return OOM_EXIT_CODE
+    if exit_code != 0:
+      if not quiet:
+        print(''.join(stderr_tail.lines))
+      if stderr_tail.oom:
+        if not quiet:
+          print('Failure was OOM')
+        return OOM_EXIT_CODE
+      return exit_code
+
+    if options.print_memoryuse:
+      print('{}(MemoryUse): {}'
+          .format(options.print_memoryuse,
+              utils.grep_memoryuse(
+                  peak_memory_file or options.track_memory_to_file)))
 
   if options.print_runtimeraw:
     print('{}(RunTimeRaw): {} ms'
         .format(options.print_runtimeraw, 1000.0 * (time.time() - t0)))
 
   if options.print_dexsegments:
-    dex_files = glob(os.path.join(outdir, '*.dex'))
-    utils.print_dexsegments(options.print_dexsegments, dex_files)
+    dex_files = get_dex_files(outdir)
+    if dex_files:
+      # All the dex files are measured by a single dexsegments run.
+      utils.print_dexsegments(options.print_dexsegments, dex_files)
   return 0
 
+def get_dex_files(outdir):
+  if not os.path.isdir(outdir):
+    return []
+  return sorted(entry.path for entry in os.scandir(outdir)
+                if entry.name.endswith('.dex') and entry.is_file())
+
 if __name__ == '__main__':
   sys.exit(main(sys.argv[1:]))
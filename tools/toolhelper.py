@@ -3,7 +3,12 @@
 # BSD-style license that can be found in the LICENSE file.
 
 import glob
+import os
+import re
+import shutil
+import signal
 import subprocess
+import threading
 from threading import Timer
 
 import gradle
@@ -14,7 +19,8 @@ import utils
 def run(tool, args, build=None, debug=True,
         profile=False, track_memory_file=None, extra_args=None,
         stderr=None, stdout=None, return_stdout=False, timeout=0, quiet=False,
-        cmd_prefix=None, jar=None, main=None):
+        cmd_prefix=None, jar=None, main=None, peak_memory_file=None,
+        stderr_handler=None, memory_watcher=None):
   cmd = []
   if cmd_prefix:
     cmd.extend(cmd_prefix)
@@ -48,9 +54,36 @@ def run(tool, args, build=None, debug=True,
     cmd.extend(["--lib", lib])
   cmd.extend(args)
   utils.PrintCmd(cmd, quiet=quiet)
+  cmd = resolve_executable(cmd)
+  if peak_memory_file or stderr_handler or memory_watcher:
+    assert not return_stdout
+    kill = lambda process: process.kill()
+    proc = subprocess.Popen(cmd, stdout=stdout,
+        stderr=subprocess.PIPE if stderr_handler else stderr,
+        close_fds=False)
+    timer = Timer(timeout, kill, [proc]) if timeout > 0 else None
+    try:
+      if timer:
+        timer.start()
+      if memory_watcher:
+        memory_watcher.start(proc.pid)
+      if stderr_handler:
+        # Pass each line of stderr on as it is written.
+        for line in iter(proc.stderr.readline, b''):
+          stderr_handler(line.decode('utf-8', 'replace'))
+        proc.stderr.close()
+      if peak_memory_file:
+        return wait_and_write_peak_memory(proc, peak_memory_file)
+      return proc.wait()
+    finally:
+      if timer:
+        timer.cancel()
+      if memory_watcher:
+        memory_watcher.stop()
   if timeout > 0:
     kill = lambda process: process.kill()
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        close_fds=False)
     timer = Timer(timeout, kill, [proc])
     try:
       timer.start()
@@ -60,8 +93,136 @@ def run(tool, args, build=None, debug=True,
     return stdout if return_stdout else proc.returncode
   else:
     if return_stdout:
-      return subprocess.check_output(cmd)
-    return subprocess.call(cmd, stdout=stdout, stderr=stderr)
+      return subprocess.check_output(cmd, close_fds=False)
+    return subprocess.call(cmd, stdout=stdout, stderr=stderr, close_fds=False)
+
+# The compiler is started many times by the benchmarking scripts. On Python 3
+# subprocess starts it with posix_spawn instead of fork and exec, avoiding the
+# copy of the page tables of this process, when the executable is given by
+# path and file descriptors are not closed in the child. Not closing them is
+# safe as Python 3 does not make the descriptors it opens inheritable.
+def resolve_executable(cmd):
+  if not utils.is_python3() or os.path.dirname(cmd[0]):
+    return cmd
+  executable = shutil.which(cmd[0])
+  return [executable] + cmd[1:] if executable else cmd
+
+# Kills a process when its resident set size stays above a limit while the
+# JVM spends nearly all of its time in garbage collection pauses, read from
+# the log written with -Xlog:gc:file=<gc_log>. A JVM that is about to run out
+# of heap can spend minutes garbage collecting before failing with an
+# OutOfMemoryError, whereas a run that just uses most of its heap still makes
+# progress between the collections. This mirrors the GC overhead limit of the
+# parallel collector, and is only a heuristic for stopping such runs early,
+# the rusage of the process is what is reported as its memory use.
+class MemoryWatcher(object):
+  INTERVAL = 0.5
+  SAMPLES = 10
+  # Fraction of the time spent in pauses, as -XX:GCTimeLimit.
+  GC_TIME_LIMIT = 0.98
+  GC_PAUSE_PATTERN = re.compile(r'\bPause\b.* ([0-9.]+)ms$')
+
+  def __init__(self, limit_kb, gc_log):
+    self.limit_kb = limit_kb
+    self.gc_log = gc_log
+    self.killed = False
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def start(self, pid):
+    self._thread = threading.Thread(target=self._watch, args=(pid,))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stopped.set()
+    if self._thread:
+      self._thread.join()
+
+  def _watch(self, pid):
+    gc_log = GcLogReader(self.gc_log)
+    try:
+      samples_above_limit = 0
+      pause_ms = 0.0
+      while not self._stopped.wait(MemoryWatcher.INTERVAL):
+        rss_kb = read_rss_kb(pid)
+        if rss_kb is None:
+          return
+        pause_ms += gc_log.read_pause_ms()
+        if rss_kb <= self.limit_kb:
+          samples_above_limit = 0
+          pause_ms = 0.0
+          continue
+        samples_above_limit += 1
+        if samples_above_limit < MemoryWatcher.SAMPLES:
+          continue
+        window_ms = samples_above_limit * MemoryWatcher.INTERVAL * 1000
+        if pause_ms >= MemoryWatcher.GC_TIME_LIMIT * window_ms:
+          self.killed = True
+          os.kill(pid, signal.SIGKILL)
+          return
+        # Still making progress, start a new window.
+        samples_above_limit = 0
+        pause_ms = 0.0
+    finally:
+      gc_log.close()
+
+# Reads the durations of the garbage collection pauses that were added to a
+# -Xlog:gc log since the last read.
+class GcLogReader(object):
+  def __init__(self, path):
+    self.path = path
+    self._file = None
+    self._partial = ''
+
+  def read_pause_ms(self):
+    if not self._file:
+      try:
+        self._file = open(self.path)
+      except (IOError, OSError):
+        # Not created by the JVM yet.
+        return 0.0
+    lines = (self._partial + self._file.read()).split('\n')
+    self._partial = lines.pop()
+    pause_ms = 0.0
+    for line in lines:
+      match = MemoryWatcher.GC_PAUSE_PATTERN.search(line)
+      if match:
+        pause_ms += float(match.group(1))
+    return pause_ms
+
+  def close(self):
+    if self._file:
+      self._file.close()
+
+# Returns the current resident set size in kB of a running process, or None if
+# it is not available.
+def read_rss_kb(pid):
+  try:
+    with open('/proc/%s/status' % pid) as status:
+      for line in status:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1])
+  except (IOError, OSError):
+    pass
+  return None
+
+# Reap the process ourselves to get the peak resident set size maintained by
+# the kernel, and write it in the format of /proc/<pid>/status such that it
+# can be read with utils.grep_memoryuse.
+def wait_and_write_peak_memory(proc, peak_memory_file):
+  (_, status, rusage) = os.wait4(proc.pid, 0)
+  if os.WIFSIGNALED(status):
+    proc.returncode = -os.WTERMSIG(status)
+  else:
+    proc.returncode = os.WEXITSTATUS(status)
+  with open(peak_memory_file, 'w') as f:
+    # ru_maxrss is in kilobytes on Linux and in bytes on Mac.
+    if utils.IsOsX():
+      f.write('VmHWM:\t%s\n' % rusage.ru_maxrss)
+    else:
+      f.write('VmHWM:\t%s kB\n' % rusage.ru_maxrss)
+  return proc.returncode
 
 def run_in_tests(tool, args, build=None, debug=True, extra_args=None):
   if build is None:
@@ -84,7 +245,7 @@ def run_in_tests(tool, args, build=None, debug=True, extra_args=None):
   cmd.extend([tool])
   cmd.extend(args)
   utils.PrintCmd(cmd)
-  return subprocess.call(cmd)
+  return subprocess.call(resolve_executable(cmd), close_fds=False)
 
 def extract_build_from_args(input_args):
   build = True
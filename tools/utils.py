@@ -6,6 +6,7 @@
 
 import hashlib
 import json
+import mmap
 import os
 import re
 import shutil
@@ -25,7 +26,8 @@ REPO_ROOT = defines.REPO_ROOT
 THIRD_PARTY = defines.THIRD_PARTY
 ANDROID_SDK = os.path.join(THIRD_PARTY, 'android_sdk')
 MEMORY_USE_TMP_FILE = 'memory_use.tmp'
-DEX_SEGMENTS_RESULT_PATTERN = re.compile('- ([^:]+): ([0-9]+)')
+# Matched against the raw output of the dexsegments and cfsegments tools.
+DEX_SEGMENTS_RESULT_PATTERN = re.compile(b'- ([^:]+): ([0-9]+)')
 BUILD = os.path.join(REPO_ROOT, 'build')
 BUILD_DEPS_DIR = os.path.join(BUILD, 'deps')
 BUILD_MAIN_DIR = os.path.join(BUILD, 'classes', 'main')
@@ -127,10 +129,10 @@ def Warn(message):
 def PrintCmd(cmd, env=None, quiet=False):
   if quiet:
     return
-  if type(cmd) is list:
+  if isinstance(cmd, (list, tuple)):
     cmd = ' '.join(cmd)
   if env:
-    env = ' '.join(['{}=\"{}\"'.format(x, y) for x, y in env.iteritems()])
+    env = ' '.join(['{}=\"{}\"'.format(x, y) for x, y in env.items()])
     print('Running: {} {}'.format(env, cmd))
   else:
     print('Running: {}'.format(cmd))
@@ -161,43 +163,66 @@ class ProgressLogger(object):
       print('')
       sys.stdout.write(ProgressLogger.UP)
 
+# The number of output lines RunCmd prints again when the command fails.
+RUN_CMD_FAILURE_TAIL_LINES = 10000
+# Output lines that make RunCmd treat the command as failed, scanned as a
+# single pattern instead of one substring search per marker.
+RUN_CMD_FAILURE_PATTERN = re.compile('|'.join(re.escape(marker) for marker in [
+    'AssertionError:',
+    'CompilationError:',
+    'CompilationFailedException:',
+    'Compilation failed',
+    'FAILURE:',
+    'org.gradle.api.ProjectConfigurationException',
+    'BUILD FAILED']))
+
 def RunCmd(cmd, env_vars=None, quiet=False, fail=True, logging=True):
   PrintCmd(cmd, env=env_vars, quiet=quiet)
-  env = os.environ.copy()
+  # Without overrides the child simply inherits our environment.
+  env = None
   if env_vars:
+    env = os.environ.copy()
     env.update(env_vars)
   process = subprocess.Popen(
       cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
   stdout = []
   logger = ProgressLogger(quiet=quiet) if logging else None
   failed = False
+  # Read whatever output is available in large blocks rather than a line at a
+  # time, the last incomplete line is kept until the rest of it arrives.
+  fd = process.stdout.fileno()
+  pending = b''
   while True:
-    line = process.stdout.readline().decode('utf-8')
-    if line != '':
-      stripped = line.rstrip()
+    block = os.read(fd, 64 * 1024)
+    if block:
+      lines = (pending + block).split(b'\n')
+      pending = lines.pop()
+    else:
+      lines = [pending] if pending else []
+    for line in lines:
+      stripped = line.decode('utf-8').rstrip()
       stdout.append(stripped)
       if logger:
         logger.log(stripped)
       # TODO(christofferqa): r8 should fail with non-zero exit code.
-      if ('AssertionError:' in stripped
-          or 'CompilationError:' in stripped
-          or 'CompilationFailedException:' in stripped
-          or 'Compilation failed' in stripped
-          or 'FAILURE:' in stripped
-          or 'org.gradle.api.ProjectConfigurationException' in stripped
-          or 'BUILD FAILED' in stripped):
+      if not failed and RUN_CMD_FAILURE_PATTERN.search(stripped):
         failed = True
-    else:
-      if logger:
-        logger.done()
-      exit_code = process.poll()
-      if exit_code or failed:
-        for line in stdout:
-          Warn(line)
-        if fail:
-          raise subprocess.CalledProcessError(
-              exit_code or -1, cmd, output='\n'.join(stdout))
-      return stdout
+    if not block:
+      break
+  process.stdout.close()
+  if logger:
+    logger.done()
+  exit_code = process.wait()
+  if exit_code or failed:
+    # Only repeat the end of the output, that is where the failure is.
+    tail = stdout[-RUN_CMD_FAILURE_TAIL_LINES:]
+    if len(tail) < len(stdout):
+      Warn('... (%s lines omitted)' % (len(stdout) - len(tail)))
+    Warn('\n'.join(tail))
+    if fail:
+      raise subprocess.CalledProcessError(
+          exit_code or -1, cmd, output='\n'.join(stdout))
+  return stdout
 
 def RunGradlew(
     args, clean=True, stacktrace=True, use_daemon=False, env_vars=None,
@@ -253,23 +278,68 @@ def DownloadFromGoogleCloudStorage(sha1_file, bucket='r8-deps', auth=False,
   else:
     subprocess.check_output(cmd)
 
+# Files up to this size are hashed from a mapping with a single update.
+SHA1_MMAP_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
 def get_sha1(filename):
-  sha1 = hashlib.sha1()
   with open(filename, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    # Mapping an empty file is an error.
+    if 0 < size <= SHA1_MMAP_MAX_SIZE:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        if hasattr(data, 'madvise'):
+          data.madvise(mmap.MADV_SEQUENTIAL)
+        sha1 = hashlib.sha1()
+        sha1.update(data)
+        return sha1.hexdigest()
+      finally:
+        data.close()
+  if hasattr(hashlib, 'file_digest'):
+    # Python 3.11+ runs the read and hash loop in C.
+    with open(filename, 'rb') as f:
+      advise_sequential_read(f)
+      return hashlib.file_digest(f, 'sha1').hexdigest()
+  sha1 = hashlib.sha1()
+  # Read into a single reused buffer instead of allocating a new chunk for
+  # every read, and skip the io layer buffering since we read big blocks.
+  buf = bytearray(1024*1024)
+  view = memoryview(buf)
+  with open(filename, 'rb', 0) as f:
+    advise_sequential_read(f)
     while True:
-      chunk = f.read(1024*1024)
-      if not chunk:
+      n = f.readinto(buf)
+      if not n:
         break
-      sha1.update(chunk)
+      sha1.update(view[:n])
   return sha1.hexdigest()
 
+def advise_sequential_read(f):
+  # Let the kernel read ahead aggressively, not available on all platforms.
+  if hasattr(os, 'posix_fadvise'):
+    try:
+      os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+      pass
+
+# HEAD does not move while the scripts run, so the git queries for the repo
+# are only done once per process.
+head_is_master = None
+head_sha1 = None
+
 def is_master():
-  remotes = subprocess.check_output(['git', 'branch', '-r', '--contains',
-                                     'HEAD'])
-  return 'origin/master' in remotes
+  global head_is_master
+  if head_is_master is None:
+    remotes = subprocess.check_output(['git', 'branch', '-r', '--contains',
+                                       'HEAD'])
+    head_is_master = 'origin/master' in remotes.decode('utf-8')
+  return head_is_master
 
 def get_HEAD_sha1():
-  return get_HEAD_sha1_for_checkout(REPO_ROOT)
+  global head_sha1
+  if head_sha1 is None:
+    head_sha1 = get_HEAD_sha1_for_checkout(REPO_ROOT)
+  return head_sha1
 
 def get_HEAD_sha1_for_checkout(checkout):
   cmd = ['git', 'rev-parse', 'HEAD']
@@ -296,6 +366,19 @@ def upload_dir_to_cloud_storage(directory, destination, is_html=False, public_re
   subprocess.check_call(cmd)
 
 def upload_file_to_cloud_storage(source, destination, public_read=True):
+  location = _gcs_location(destination)
+  if location and not destination.endswith('/'):
+    (client, bucket, name) = location
+    blob = client.bucket(bucket).blob(name)
+    try:
+      # The content type is guessed from the file name, as gsutil does.
+      blob.upload_from_filename(
+          source, predefined_acl='publicRead' if public_read else None)
+      return
+    except gcs_errors:
+      # For instance a predefined ACL is rejected on a bucket with uniform
+      # bucket-level access, leave reporting such errors to gsutil.
+      pass
   cmd = ['gsutil.py', 'cp']
   if public_read:
     cmd += ['-a', 'public-read']
@@ -303,19 +386,116 @@ def upload_file_to_cloud_storage(source, destination, public_read=True):
   PrintCmd(cmd)
   subprocess.check_call(cmd)
 
+# Uploads all the sources to the destination directory with a single parallel
+# gsutil invocation, the source names are passed on stdin.
+def upload_files_to_cloud_storage(sources, destination, public_read=True):
+  cmd = ['gsutil.py', '-m', 'cp']
+  if public_read:
+    cmd += ['-a', 'public-read']
+  cmd += ['-I', destination]
+  PrintCmd(cmd)
+  process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+  process.communicate(''.join(source + '\n' for source in sources).encode())
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, cmd)
+
 def delete_file_from_cloud_storage(destination):
-  cmd = ['gsutil.py', 'rm', destination]
+  delete_files_from_cloud_storage([destination])
+
+def delete_files_from_cloud_storage(destinations):
+  cmd = ['gsutil.py']
+  if len(destinations) > 1:
+    cmd.append('-m')
+  cmd += ['rm'] + list(destinations)
   PrintCmd(cmd)
   subprocess.check_call(cmd)
 
+# The google-cloud-storage client if it is installed and has credentials,
+# otherwise None. Talking to the API directly avoids starting a gsutil process
+# for small requests.
+gcs_client = None
+gcs_client_created = False
+gcs_exceptions = None
+# The errors for which an operation is retried with gsutil, which may still
+# succeed with its own credentials and configuration.
+gcs_errors = ()
+
+def _gcs_client():
+  global gcs_client, gcs_client_created, gcs_exceptions, gcs_errors
+  if not gcs_client_created:
+    gcs_client_created = True
+    # Imported on first use since loading the library is slow and most scripts
+    # importing utils never touch cloud storage.
+    try:
+      from google.api_core import exceptions as gcs_exceptions
+      from google.auth import exceptions as gcs_auth_exceptions
+      from google.cloud import storage
+    except ImportError:
+      # Not installed, all cloud storage operations go through gsutil.
+      return None
+    gcs_errors = (gcs_exceptions.GoogleAPIError,
+                  gcs_auth_exceptions.GoogleAuthError)
+    try:
+      gcs_client = storage.Client()
+    except Exception:
+      # No default credentials, gsutil has its own.
+      gcs_client = None
+  return gcs_client
+
+# Returns (client, bucket name, object name) if the destination can be
+# accessed through the google-cloud-storage client, otherwise None.
+def _gcs_location(destination):
+  if not destination.startswith('gs://'):
+    return None
+  client = _gcs_client()
+  if client is None:
+    return None
+  bucket, _, name = destination[len('gs://'):].partition('/')
+  return (client, bucket, name)
+
 def ls_files_on_cloud_storage(destination):
+  location = _gcs_location(destination)
+  if location:
+    (client, bucket, name) = location
+    try:
+      if name and client.bucket(bucket).blob(name).exists():
+        entries = [name]
+      else:
+        prefix = name.rstrip('/') + '/' if name else ''
+        blobs = client.list_blobs(bucket, prefix=prefix, delimiter='/')
+        # The prefixes are only populated once the blobs have been iterated.
+        entries = [blob.name for blob in blobs]
+        entries += list(blobs.prefixes)
+    except gcs_errors:
+      entries = None
+    if entries is not None:
+      if not entries:
+        raise subprocess.CalledProcessError(1, ['ls', destination])
+      listing = ''.join(
+          'gs://%s/%s\n' % (bucket, entry) for entry in sorted(entries))
+      # Same type as the gsutil output.
+      return listing.encode('utf-8')
   cmd = ['gsutil.py', 'ls', destination]
   PrintCmd(cmd)
   return subprocess.check_output(cmd)
 
-def cat_file_on_cloud_storage(destination, ignore_errors=False):
+def cat_file_on_cloud_storage(destination, ignore_errors=False, quiet=False):
+  location = _gcs_location(destination)
+  if location:
+    (client, bucket, name) = location
+    blob = client.bucket(bucket).blob(name)
+    try:
+      if hasattr(blob, 'download_as_bytes'):
+        return blob.download_as_bytes()
+      return blob.download_as_string()
+    except gcs_exceptions.NotFound as e:
+      if ignore_errors:
+        return ''
+      raise e
+    except gcs_errors:
+      pass
   cmd = ['gsutil.py', 'cat', destination]
-  PrintCmd(cmd)
+  PrintCmd(cmd, quiet=quiet)
   try:
     return subprocess.check_output(cmd)
   except subprocess.CalledProcessError as e:
@@ -324,9 +504,34 @@ def cat_file_on_cloud_storage(destination, ignore_errors=False):
     else:
       raise e
 
-def file_exists_on_cloud_storage(destination):
+# Yields (gs location, content) for all files with the given name below the
+# directory on cloud storage, using a single parallel copy instead of one
+# gsutil call per file.
+def cat_files_on_cloud_storage(destination, name):
+  destination = destination.rstrip('/')
+  with TempDir() as temp:
+    cmd = ['gsutil.py', '-m', 'cp', '-R', destination, temp]
+    PrintCmd(cmd)
+    subprocess.check_call(cmd)
+    local_root = os.path.join(temp, os.path.basename(destination))
+    for root, dirs, files in os.walk(local_root):
+      dirs.sort()
+      if name in files:
+        relative = os.path.relpath(os.path.join(root, name), local_root)
+        with open(os.path.join(root, name)) as f:
+          yield ('%s/%s' % (destination, relative.replace(os.sep, '/')),
+                 f.read())
+
+def file_exists_on_cloud_storage(destination, quiet=False):
+  location = _gcs_location(destination)
+  if location:
+    (client, bucket, name) = location
+    try:
+      return client.bucket(bucket).blob(name).exists()
+    except gcs_errors:
+      pass
   cmd = ['gsutil.py', 'ls', destination]
-  PrintCmd(cmd)
+  PrintCmd(cmd, quiet=quiet)
   return subprocess.call(cmd) == 0
 
 def download_file_from_cloud_storage(source, destination, quiet=False):
@@ -338,6 +543,23 @@ def create_archive(name, sources=None):
   if not sources:
     sources = [name]
   tarname = '%s.tar.gz' % name
+  pigz = shutil.which('pigz') if hasattr(shutil, 'which') else None
+  if pigz:
+    # Compression is the expensive part, let pigz do it on all cores.
+    cmd = [pigz, '-n']
+    with open(tarname, 'wb') as output:
+      process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=output)
+      try:
+        with tarfile.open(
+            fileobj=process.stdin, mode='w|', bufsize=1024*1024) as tar:
+          for source in sources:
+            tar.add(source)
+      finally:
+        process.stdin.close()
+        exit_code = process.wait()
+    if exit_code != 0:
+      raise subprocess.CalledProcessError(exit_code, cmd)
+    return tarname
   with tarfile.open(tarname, 'w:gz') as tar:
     for source in sources:
       tar.add(source)
@@ -353,6 +575,9 @@ def unpack_archive(filename):
     shutil.rmtree(dest_dir)
   dirname = os.path.dirname(os.path.abspath(filename))
   with tarfile.open(filename, 'r:gz') as tar:
+    # Copy the members with a larger buffer than the default 16 KiB, this is
+    # only used on Python 3.8+.
+    tar.copybufsize = 1024 * 1024
     tar.extractall(path=dirname)
 
 def check_gcert():
@@ -361,9 +586,21 @@ def check_gcert():
 # Note that gcs is eventually consistent with regards to list operations.
 # This is not a problem in our case, but don't ever use this method
 # for synchronization.
-def cloud_storage_exists(destination):
+def cloud_storage_exists(destination, quiet=False):
+  location = _gcs_location(destination)
+  if location:
+    (client, bucket, name) = location
+    try:
+      if name and client.bucket(bucket).blob(name).exists():
+        return True
+      # The destination can also be a directory.
+      prefix = name.rstrip('/') + '/' if name else ''
+      return any(True for _ in client.list_blobs(
+          bucket, prefix=prefix, max_results=1))
+    except gcs_errors:
+      pass
   cmd = ['gsutil.py', 'ls', destination]
-  PrintCmd(cmd)
+  PrintCmd(cmd, quiet=quiet)
   exit_code = subprocess.call(cmd)
   return exit_code == 0
 
@@ -412,48 +649,57 @@ class CtsTest(object):
     self.name = test_name
     self.outcome = outcome
 
+# Matches the Module, TestCase and Test elements of a CTS test_result.xml.
+CTS_TEST_RESULT_PATTERN = re.compile(
+    '<(?:(Module|TestCase) |Test result="(pass|fail)" )name="([^"]*)"')
+# Whether a test passed, by the outcomes the pattern above accepts.
+CTS_TEST_OUTCOMES = {'pass': True, 'fail': False}
+
 # Generator yielding CtsModule, CtsTestCase or CtsTest from
 # reading through a CTS test_result.xml file.
 def read_cts_test_result(file_xml):
-  re_module = re.compile('<Module name="([^"]*)"')
-  re_test_case = re.compile('<TestCase name="([^"]*)"')
-  re_test = re.compile('<Test result="(pass|fail)" name="([^"]*)"')
   with open(file_xml) as f:
-    for line in f:
-      m = re_module.search(line)
-      if m:
-        yield CtsModule(m.groups()[0])
-        continue
-      m = re_test_case.search(line)
-      if m:
-        yield CtsTestCase(m.groups()[0])
-        continue
-      m = re_test.search(line)
-      if m:
-        outcome = m.groups()[0]
-        assert outcome in ['fail', 'pass']
-        yield CtsTest(m.groups()[1], outcome == 'pass')
+    content = f.read()
+  for m in CTS_TEST_RESULT_PATTERN.finditer(content):
+    (element, outcome, name) = m.groups()
+    if element == 'Module':
+      yield CtsModule(name)
+    elif element == 'TestCase':
+      yield CtsTestCase(name)
+    else:
+      yield CtsTest(name, CTS_TEST_OUTCOMES[outcome])
+
+# Matches a VmHWM line of a memory use log, the last one is the peak.
+VMHWM_PATTERN = re.compile(b'VmHWM:[ \t]*([0-9]+)[ \t]*([a-zA-Z]*)')
 
 def grep_memoryuse(logfile):
-  re_vmhwm = re.compile('^VmHWM:[ \t]*([0-9]+)[ \t]*([a-zA-Z]*)')
-  result = None
-  with open(logfile) as f:
-    for line in f:
-      m = re_vmhwm.search(line)
-      if m:
-        groups = m.groups()
-        s = len(groups)
-        if s >= 1:
-          result = int(groups[0])
-          if s >= 2:
-            unit = groups[1]
-            if unit == 'kB':
-              result *= 1024
-            elif unit != '':
-              raise Exception('Unrecognized unit in memory usage log: {}'
-                  .format(unit))
-  if result is None:
+  groups = None
+  with open(logfile, 'rb') as f:
+    # Mapping an empty file is an error and there is nothing to find anyway.
+    if os.fstat(f.fileno()).st_size > 0:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        # The log is appended to while tracking, so search from the end.
+        end = len(data)
+        while groups is None:
+          start = data.rfind(b'VmHWM:', 0, end)
+          if start < 0:
+            break
+          if start == 0 or data[start - 1:start] == b'\n':
+            m = VMHWM_PATTERN.match(data, start)
+            if m:
+              # Copy out of the mapping before it is closed.
+              groups = (int(m.group(1)), m.group(2).decode('utf-8'))
+          end = start
+      finally:
+        data.close()
+  if groups is None:
     raise Exception('No memory usage found in log: {}'.format(logfile))
+  (result, unit) = groups
+  if unit == 'kB':
+    result *= 1024
+  elif unit != '':
+    raise Exception('Unrecognized unit in memory usage log: {}'.format(unit))
   return result
 
 # Return a dictionary: {segment_name -> segments_size}
@@ -462,19 +708,34 @@ def getDexSegmentSizes(dex_files):
   cmd = [jdk.GetJavaExecutable(), '-jar', R8_JAR, 'dexsegments']
   cmd.extend(dex_files)
   PrintCmd(cmd)
-  output = subprocess.check_output(cmd).decode('utf-8')
-
-  matches = DEX_SEGMENTS_RESULT_PATTERN.findall(output)
+  process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
 
-  if matches is None or len(matches) == 0:
+  # Match the output while the tool is still running instead of collecting
+  # all of it first. Only complete lines are matched, the rest is kept for
+  # the next block.
+  result = {}
+  pending = b''
+  while True:
+    block = process.stdout.read(64 * 1024)
+    if block:
+      pending += block
+      end = pending.rfind(b'\n') + 1
+    else:
+      end = len(pending)
+    for match in DEX_SEGMENTS_RESULT_PATTERN.finditer(pending, 0, end):
+      result[match.group(1).decode('utf-8')] = int(match.group(2))
+    pending = pending[end:]
+    if not block:
+      break
+  process.stdout.close()
+  exit_code = process.wait()
+  if exit_code != 0:
+    raise subprocess.CalledProcessError(exit_code, cmd)
+
+  if len(result) == 0:
     raise Exception('DexSegments failed to return any output for' \
         ' these files: {}'.format(dex_files))
 
-  result = {}
-
-  for match in matches:
-    result[match[0]] = int(match[1])
-
   return result
 
 # Return a dictionary: {segment_name -> segments_size}
@@ -496,7 +757,7 @@ def getCfSegmentSizes(cfFile):
   result = {}
 
   for match in matches:
-    result[match[0]] = int(match[1])
+    result[match[0].decode('utf-8')] = int(match[1])
 
   return result
 
@@ -514,9 +775,16 @@ def print_dexsegments(prefix, dex_files):
     print('{}-{}(CodeSize): {}'
         .format(prefix, segment_name, size))
 
+# The java executables that passed check_java_version, so that each of them is
+# only run with -version once per process.
+java_versions_checked = set()
+
 # Ensure that we are not benchmarking with a google jvm.
 def check_java_version():
-  cmd= [jdk.GetJavaExecutable(), '-version']
+  java = jdk.GetJavaExecutable()
+  if java in java_versions_checked:
+    return
+  cmd= [java, '-version']
   output = subprocess.check_output(cmd, stderr = subprocess.STDOUT)
   m = re.search('openjdk version "([^"]*)"', output.decode('utf-8'))
   if m is None:
@@ -526,6 +794,7 @@ def check_java_version():
   m = re.search('google', version)
   if m is not None:
     raise Exception("Do not use google JVM for benchmarking: " + version)
+  java_versions_checked.add(java)
 
 def get_android_jar_dir(api):
   return os.path.join(REPO_ROOT, ANDROID_JAR_DIR.format(api=api))
@@ -533,17 +802,34 @@ def get_android_jar_dir(api):
 def get_android_jar(api):
   return os.path.join(REPO_ROOT, ANDROID_JAR.format(api=api))
 
+ANDROID_OPTIONAL_JARS = [
+  'android.test.base.jar',
+  'android.test.mock.jar',
+  'android.test.runner.jar',
+  'org.apache.http.legacy.jar'
+]
+
+# Map from api to the optional jars present for that api.
+android_optional_jars_cache = {}
+
 def get_android_optional_jars(api):
-  android_optional_jars_dir = os.path.join(get_android_jar_dir(api), 'optional')
-  android_optional_jars = [
-    os.path.join(android_optional_jars_dir, 'android.test.base.jar'),
-    os.path.join(android_optional_jars_dir, 'android.test.mock.jar'),
-    os.path.join(android_optional_jars_dir, 'android.test.runner.jar'),
-    os.path.join(android_optional_jars_dir, 'org.apache.http.legacy.jar')
-  ]
-  return [
-      android_optional_jar for android_optional_jar in android_optional_jars
-      if os.path.isfile(android_optional_jar)]
+  if api not in android_optional_jars_cache:
+    android_optional_jars_dir = os.path.join(
+        get_android_jar_dir(api), 'optional')
+    if hasattr(os, 'scandir') and os.path.isdir(android_optional_jars_dir):
+      # One directory listing, which also has the file types, instead of a
+      # stat per jar.
+      present = set(
+          entry.name for entry in os.scandir(android_optional_jars_dir)
+          if entry.is_file())
+    else:
+      present = set(
+          jar for jar in ANDROID_OPTIONAL_JARS
+          if os.path.isfile(os.path.join(android_optional_jars_dir, jar)))
+    android_optional_jars_cache[api] = [
+        os.path.join(android_optional_jars_dir, jar)
+        for jar in ANDROID_OPTIONAL_JARS if jar in present]
+  return list(android_optional_jars_cache[api])
 
 def is_bot():
   return 'SWARMING_BOT_ID' in os.environ